@@ -1,10 +1,153 @@
+import contextlib
+import importlib.util
 import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
 import arcpy
 import numpy as np
 import pandas as pd
 from useful_functions import init_logger
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, non-integer aggregation then falls back to arcpy Aggregate + Resample
+    njit = None
+
+
+def _block_sum_resample(arr, ratio, ny, nx):
+    """
+    Sums input cells into output cells 'ratio' times larger, weighting each input cell by the fraction of its area that
+    falls in the output cell (NaN is ignored), so a uniform input stays uniform for any ratio
+    :param arr: a 2D float32 numpy array w/ NaN as NoData
+    :param ratio: output cell size / input cell size (float > 1)
+    :param ny: number of output rows
+    :param nx: number of output columns
+    :return: a 2D float32 numpy array of shape (ny, nx), NaN where an output cell has no valid input cells
+    >>> out = _block_sum_resample(np.ones((10, 10), dtype=np.float32), 2.5, 4, 4)
+    >>> bool(np.allclose(out, 6.25))
+    True
+    """
+    rows, cols = arr.shape
+    out = np.full((ny, nx), np.nan, dtype=np.float32)
+
+    for i in range(ny):
+        # output row i covers input rows [i * ratio, (i + 1) * ratio)
+        y0 = i * ratio
+        y1 = (i + 1) * ratio
+        r0 = int(np.floor(y0))
+        r1 = min(int(np.ceil(y1)), rows)
+        for j in range(nx):
+            x0 = j * ratio
+            x1 = (j + 1) * ratio
+            c0 = int(np.floor(x0))
+            c1 = min(int(np.ceil(x1)), cols)
+            total = 0.0
+            valid = False
+            for r in range(r0, r1):
+                row_frac = min(r + 1, y1) - max(r, y0)
+                for c in range(c0, c1):
+                    v = arr[r, c]
+                    if not np.isnan(v):
+                        total += v * row_frac * (min(c + 1, x1) - max(c, x0))
+                        valid = True
+            if valid:
+                out[i, j] = total
+
+    return out
+
+
+# compiled single threaded, rasters are already resampled in parallel worker processes (see _process_one())
+if njit is not None:
+    _block_sum_resample = njit(cache=True)(_block_sum_resample)
+
+
+def _sum_resample(file, out_file, ratio):
+    """
+    Sum aggregates a raster to a cell size that is not an integer multiple of its own in a single pass (w/o temp files)
+    :param file: path of the input .tif raster
+    :param out_file: path of the output .tif raster
+    :param ratio: output cell size / input cell size (float > 1)
+    :return: the output raster path
+    """
+    import rasterio
+    from rasterio.transform import Affine
+
+    with rasterio.open(file) as src:
+        arr = src.read(1).astype(np.float32)
+        if src.nodata is not None:
+            arr[arr == src.nodata] = np.nan
+
+        ny = int(np.ceil(src.height / ratio))
+        nx = int(np.ceil(src.width / ratio))
+        profile = src.profile
+
+    out = _block_sum_resample(arr, ratio, ny, nx)
+
+    # write w/ the input grid origin and the scaled cell size
+    for key in ['blockxsize', 'blockysize', 'tiled']:
+        profile.pop(key, None)
+    profile.update(height=ny, width=nx, count=1, dtype='float32', nodata=np.nan,
+                   transform=profile['transform'] * Affine.scale(ratio))
+
+    with rasterio.open(out_file, 'w', **profile) as dst:
+        dst.write(out, 1)
+
+    return out_file
+
+
+def _process_one(file, i, cell_size, in_cell_size, out_folder, agg):
+    """
+    Worker used by batch_resample_or_aggregate() to resample or aggregate a single raster in a separate process
+    :param file: path of the input .tif raster
+    :param i: index of the raster in the batch, used to name aggregated outputs (agg#.tif)
+    :param cell_size: the output cell size (float or int) in the same units of the raster
+    :param in_cell_size: the input cell size (float)
+    :param out_folder: folder to save the output raster in
+    :param agg: Bool. If true, a SUM aggregation is used instead of bilinear resampling
+    :return: a tuple w/ (input name, output path, temp file path or None, arcpy error messages or None)
+    """
+    # arcpy environment settings are not inherited by worker processes
+    arcpy.env.overwriteOutput = True
+    name = os.path.split(file)[1]
+    out_file = None
+    temp = None
+
+    try:
+        if not agg:
+            # create output path then resample
+            out_file = out_folder + '\\%s' % name
+            arcpy.Resample_management(file, out_file, cell_size, 'BILINEAR')
+
+        # if agg == True, either aggregate to the output cell size (if divisible) or aggregate and then resample
+        else:
+            out_file = out_folder + '\\agg%s.tif' % i
+
+            factor = int(cell_size // in_cell_size)
+            if cell_size % in_cell_size == 0:
+                in_ras = arcpy.sa.Raster(file)
+                out_ras = arcpy.sa.Aggregate(in_ras, factor, 'Sum')
+                out_ras.save(out_file)
+
+            # non-integer factors are summed straight to the output cell size in one numba pass if possible
+            elif njit is not None and importlib.util.find_spec('rasterio') is not None:
+                _sum_resample(file, out_file, cell_size / in_cell_size)
+
+            else:
+                temp = out_folder + '\\temp%s.tif' % i
+                in_ras = arcpy.sa.Raster(file)
+                out_agg = arcpy.sa.Aggregate(in_ras, factor, 'Sum')
+                out_agg.save(temp)
+                out_ras = arcpy.sa.Resample(out_agg, 'Average', output_cellsize=cell_size)
+                out_ras.save(out_file)
+
+    except arcpy.ExecuteError:
+        return name, out_file, temp, str(arcpy.GetMessages())
+
+    except OSError as e:
+        return name, out_file, temp, str(e)
+
+    return name, out_file, temp, None
+
 
 def batch_resample_or_aggregate(in_folder, cell_size, out_folder='', str_in='.tif', agg=False):
     """
@@ -21,10 +164,8 @@ def batch_resample_or_aggregate(in_folder, cell_size, out_folder='', str_in='.ti
     arcpy.env.overwriteOutput = True
     del_files = []
 
-    # create list of valid input files
-    all_files = os.listdir(in_folder)
-    in_files = [in_folder + '\\%s' % i for i in all_files if str_in in i]
-    in_files = [i for i in in_files if i[-4:] == '.tif']
+    # create list of valid input files in a single directory scan
+    in_files = [e.path for e in os.scandir(in_folder) if e.is_file() and str_in in e.name and e.name.endswith('.tif')]
     if len(in_files) == 0:
         return print('ERROR. No valid input .tif files w/ %s in their name. Please run again.' % str_in)
 
@@ -48,45 +189,26 @@ def batch_resample_or_aggregate(in_folder, cell_size, out_folder='', str_in='.ti
     if not os.path.exists(out_folder):
         os.makedirs(out_folder)
 
-    # select raster files to process and resample or aggregate then resample
-    for i, file in enumerate(in_files):
-        name = os.path.split(file)[1]
-        try:
-            if not agg:
-                # create output path then resample
-                out_file = out_folder + '\\%s' % name
-
-                arcpy.Resample_management(file, out_file, cell_size, 'BILINEAR')
-                logging.info('Resampled %s' % name)
-
-            # if agg == True, either aggregate to the output cell size (if divisible) or aggregate and then resample
+    # resample or aggregate each raster in its own process (arcpy/GDAL are not thread safe), logging results as they
+    # stream in and recording which of the newly named aggregate rasters correspond to what in one open text file
+    n = len(in_files)
+    key_txt = open(out_folder + '\\aggregate_key.txt', 'w') if agg else contextlib.nullcontext()
+
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor, key_txt as out_txt:
+        results = executor.map(_process_one, in_files, range(n), [cell_size] * n, [in_cell_size] * n,
+                               [out_folder] * n, [agg] * n)
+
+        for name, out_file, temp, error in results:
+            if temp is not None:
+                del_files.append(temp)
+            if error is not None:
+                logging.info(error)
+                logging.info('ERROR, skipped %s' % name)
             elif agg:
-                # create text file to record which of the newly named rasters correspond to what
-                txt_dir = out_folder + '\\aggregate_key.txt'
-                out_txt = open(txt_dir, 'w+')
-                out_file = out_folder + '\\agg%s.tif' % i
-
-                factor = int(cell_size // in_cell_size)
-                if cell_size % in_cell_size == 0:
-                    in_ras = arcpy.sa.Raster(file)
-                    out_ras = arcpy.sa.Aggregate(in_ras, factor, 'Sum')
-                else:
-                    temp = out_folder + '\\temp%s.tif' % i
-                    in_ras = arcpy.sa.Raster(file)
-                    out_agg = arcpy.sa.Aggregate(in_ras, factor, 'Sum')
-                    out_agg.save(temp)
-                    del_files.append(temp)
-                    out_ras = arcpy.sa.Resample(out_agg, 'Average', output_cellsize=cell_size)
-
-                # Save the output
                 out_txt.write('\n %s -> %s\n' % (name, out_file))
-                out_ras.save(out_file)
                 logging.info('Aggregated %s' % name)
-                out_txt.close()
-
-        except arcpy.ExecuteError:
-            logging.info(str(arcpy.GetMessages()))
-            logging.info('ERROR, skipped %s' % name)
+            else:
+                logging.info('Resampled %s' % name)
 
     # delete extra files
     for file in del_files:
@@ -98,6 +220,24 @@ def batch_resample_or_aggregate(in_folder, cell_size, out_folder='', str_in='.ti
     return out_folder
 
 
+def _project_one(file, out_ras, out_sr):
+    """
+    Worker used by batch_raster_project() to project a single raster in a separate process
+    :param file: path of the input .tif raster
+    :param out_ras: path of the output raster
+    :param out_sr: the output coordinate system as a string (i.e., from SpatialReference.exportToString())
+    :return: arcpy error messages (str) if the projection failed, otherwise None
+    """
+    arcpy.env.overwriteOutput = True
+
+    try:
+        arcpy.ProjectRaster_management(file, out_ras, out_coor_system=out_sr, resampling_type='BILINEAR')
+    except arcpy.ExecuteError:
+        return str(arcpy.GetMessages())
+
+    return None
+
+
 def batch_raster_project(in_folder, spatial_ref, out_folder='', suffix='_p.tif'):
     """
     This function batch projects rasters and places them in a new flder
@@ -112,21 +252,24 @@ def batch_raster_project(in_folder, spatial_ref, out_folder='', suffix='_p.tif')
     arcpy.env.overwriteOutput = True
     del_files = []
 
-    # create list of valid input files
-    all_files = os.listdir(in_folder)
-    in_names = [i for i in all_files if i[-4:] == '.tif']
-    in_files = [in_folder + '\\%s' % i for i in in_names]
+    # create list of valid input files in a single directory scan
+    entries = [e for e in os.scandir(in_folder) if e.is_file() and e.name.endswith('.tif')]
+    in_names = [e.name for e in entries]
+    in_files = [e.path for e in entries]
     if len(in_files) == 0:
         return print('ERROR. No valid input .tif files in %s. Please run again.' % in_folder)
 
-    # create output spatial reference object
+    # create output spatial reference string (arcpy spatial reference objects do not pickle reliably)
     if isinstance(spatial_ref, str):
         ext = spatial_ref[-4:]
         if ext == '.tif' or ext == '.shp':
-            out_sr = arcpy.Describe(spatial_ref).spatialReference
+            out_sr = arcpy.Describe(spatial_ref).spatialReference.exportToString()
         else:
             out_sr = spatial_ref
 
+    elif isinstance(spatial_ref, arcpy.SpatialReference):
+        out_sr = spatial_ref.exportToString()
+
     else:
         return print('spatial_ref must be a .tif, .shp, or a arcpy spatial reference object')
 
@@ -137,22 +280,62 @@ def batch_raster_project(in_folder, spatial_ref, out_folder='', suffix='_p.tif')
     if not os.path.exists(out_folder):
         os.makedirs(out_folder)
 
-    # project and save rasters
-    for i, file in enumerate(in_files):
-        name = in_names[i]
-        out_ras = out_folder + '\\%s' % name.replace('.tif', suffix)
-
-        try:
-            arcpy.ProjectRaster_management(file, out_ras, out_coor_system=out_sr, resampling_type='BILINEAR')
-            logging.info('Projected %s -> %s' % (name, out_ras))
+    # project and save rasters, one process per raster
+    out_rasters = [out_folder + '\\%s' % name.replace('.tif', suffix) for name in in_names]
+    with ProcessPoolExecutor(max_workers=min(8, len(in_files))) as executor:
+        futures = [executor.submit(_project_one, file, out_rasters[i], out_sr) for i, file in enumerate(in_files)]
 
-        except arcpy.ExecuteError:
-            logging.info(str(arcpy.GetMessages()))
-            logging.info('ERROR, skipped %s' % file)
+        for i, future in enumerate(futures):
+            error = future.result()
+            if error is None:
+                logging.info('Projected %s -> %s' % (in_names[i], out_rasters[i]))
+            else:
+                logging.info(error)
+                logging.info('ERROR, skipped %s' % in_files[i])
 
     return out_folder
 
 
+def _rasterio_sample(ras, points):
+    """
+    Samples a raster at point locations in memory using rasterio (no intermediate tables are written to disk).
+    Only the internal raster blocks containing points are read.
+    :param ras: path of the raster to sample
+    :param points: a geopandas GeoDataFrame of sample points
+    :return: a float32 numpy array w/ the first band value at each point (NaN where NoData)
+    """
+    import rasterio
+
+    with rasterio.open(ras) as src:
+        if points.crs is not None and src.crs is not None and points.crs != src.crs:
+            points = points.to_crs(src.crs)
+
+        # compute every point's pixel row/col at once w/ the inverse affine transform (points outside stay NaN)
+        vals = np.full(len(points), np.nan, dtype=np.float32)
+        cols, rows = ~src.transform * (points.geometry.x.to_numpy(), points.geometry.y.to_numpy())
+        rows = np.floor(rows).astype(np.int64)
+        cols = np.floor(cols).astype(np.int64)
+        inside = np.flatnonzero((rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width))
+
+        # group points by the internal raster block they fall in
+        block_h, block_w = src.block_shapes[0]
+        n_block_cols = -(-src.width // block_w)
+        block_ids = (rows[inside] // block_h) * n_block_cols + cols[inside] // block_w
+        order = np.argsort(block_ids, kind='stable')
+        uniq_ids, starts = np.unique(block_ids[order], return_index=True)
+
+        # read each occupied block once and pull all of its point values from memory
+        for block_id, members in zip(uniq_ids, np.split(inside[order], starts[1:])):
+            win = src.block_window(1, int(block_id // n_block_cols), int(block_id % n_block_cols))
+            arr = src.read(1, window=win)
+            vals[members] = arr[rows[members] - win.row_off, cols[members] - win.col_off]
+
+        if src.nodata is not None:
+            vals[vals == src.nodata] = np.nan
+
+    return vals
+
+
 def simple_raster_sample(in_table, sample_points, var_dict):
     """
     Plain bagel raster sampling (w/o month or days)
@@ -168,9 +351,20 @@ def simple_raster_sample(in_table, sample_points, var_dict):
     out_dir = os.path.dirname(sample_points)
     arcpy.env.overwriteOutput = True
     out_csv = in_table.replace('.csv', '_export.csv')
-    temp_files = out_dir + '\\temp_files'
-    if not os.path.exists(temp_files):
-        os.makedirs(temp_files)
+
+    # sample in memory w/ rasterio if available, otherwise fall back to arcpy Sample tables
+    points = None
+    if importlib.util.find_spec('rasterio') is not None and importlib.util.find_spec('geopandas') is not None:
+        import geopandas as gpd
+        try:
+            points = gpd.read_file(sample_points)
+        except Exception as e:  # i.e., a geodatabase feature class GDAL cannot open, arcpy can still sample it
+            logging.info('Could not read %s w/ geopandas (%s), sampling w/ arcpy instead' % (sample_points, e))
+
+    if points is None:
+        temp_files = out_dir + '\\temp_files'
+        if not os.path.exists(temp_files):
+            os.makedirs(temp_files)
 
     # set variables names
     var_names = list(var_dict.keys())
@@ -182,28 +376,32 @@ def simple_raster_sample(in_table, sample_points, var_dict):
 
     for var in var_names:
         ras = var_dict[var]
-        ras_name = os.path.basename(ras)[:-4]
         logging.info('Pulling station point %s values...' % var)
+
+        if points is not None:
+            samp_df = pd.DataFrame({'station_id': points['station_id'].values, var: _rasterio_sample(ras, points)})
+            samp_dfs.append(samp_df)
+            continue
+
+        ras_name = os.path.basename(ras)[:-4]
         t_dbf = temp_files + '\\%s_sample.dbf' % var
-        t_csv = t_dbf.replace('.dbf', '.csv')
 
         # make a sample dataframe with a _Band_# header suffixes where # is the month index
         sample_table = arcpy.sa.Sample(ras, sample_points, t_dbf, unique_id_field='station_id')
 
-        if os.path.exists(t_csv):
-            os.remove(t_csv)
-
-        arcpy.TableToTable_conversion(sample_table, os.path.dirname(t_csv), os.path.basename(t_csv))
-
-        samp_df = pd.read_csv(t_csv)
+        # read the sample table straight into memory w/ a cursor, no intermediate csv (NoData is read as None, which
+        # becomes NaN for float and integer rasters alike)
+        fields = [f.name for f in arcpy.ListFields(sample_table) if f.type not in ['Geometry', 'Blob', 'Raster']]
+        with arcpy.da.SearchCursor(sample_table, fields) as cursor:
+            samp_df = pd.DataFrame.from_records(list(cursor), columns=fields)
         samp_df.rename(columns={ras_name: var, 'no2_annual': 'station_id'}, inplace=True)
+        samp_df[var] = pd.to_numeric(samp_df[var])
         samp_dfs.append(samp_df)
 
-    # join to the daily observation csv
-    for i, df in enumerate(samp_dfs):
-        var = var_names[i]
-        out_df = out_df.merge(df, on=['station_id'], how='left')
-        out_df[var] = out_df[var].fillna(0)
+    # align all sampled variables on station_id and join them to the daily observation csv in one merge
+    sampled = pd.concat([df.set_index('station_id')[[var_names[i]]] for i, df in enumerate(samp_dfs)], axis=1)
+    out_df = out_df.merge(sampled, left_on='station_id', right_index=True, how='left')
+    out_df[var_names] = out_df[var_names].fillna(0)
 
     out_df.to_csv(out_csv)
     logging.info('Done\nOutput csv with variables %s @ %s' % (var_names, out_csv))
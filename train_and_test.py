@@ -4,20 +4,16 @@ A pipeline that trains, tunes, and tests an XGBoost model using a .csv file inpu
 author @xaviernogueira
 """
 
+import importlib.util
 import os.path
-import matplotlib.pyplot as plt
-import seaborn as sns
+import re
 import pandas as pd
 import numpy as np
-import xgboost as xgb
-import sklearn
-import joblib
 import logging
-from sklearn.model_selection import GridSearchCV
-from sklearn.metrics import r2_score
-from sklearn.metrics import mean_squared_error
 from useful_functions import init_logger
 
+RUN_DIR_PATTERN = re.compile(r'^Run(\d+)$')
+
 
 def prep_input(in_data, in_cols, test_prop):
     """
@@ -31,18 +27,15 @@ def prep_input(in_data, in_cols, test_prop):
     from sklearn.model_selection import train_test_split
     logging.info('Prepping input data')
 
-    # standardize column headers
-    for col in list(in_data.columns):
-        if in_data[col].dtypes == object:
-            in_data[col].replace(' ', '_', regex=True, inplace=True)
-        if ' ' in str(col)[:-1]:
-            new = str(col).replace(' ', '_')
-            if new[-1] == '_':
-                new = new[:-1]
-            in_data.rename(columns={str(col): new}, inplace=True)
+    # standardize text values and column headers (spaces -> underscores, no trailing whitespace)
+    obj_cols = in_data.select_dtypes(['object', 'string']).columns
+    if len(obj_cols) > 0:
+        in_data[obj_cols] = in_data[obj_cols].replace(' ', '_', regex=True)
+    in_data.columns = in_data.columns.astype(str).str.rstrip().str.replace(' ', '_', regex=False)
 
-    # keep only in_cols
-    in_data = in_data[in_cols]
+    # keep only in_cols (skips the copy when in_data was already read w/ only in_cols)
+    if list(in_data.columns) != list(in_cols):
+        in_data = in_data[in_cols]
 
     # split to X and Y data
     ytr = in_data['mean_no2'].values  # define y variable
@@ -57,6 +50,52 @@ def prep_input(in_data, in_cols, test_prop):
     return out
 
 
+def save_splits(X_train, X_test, y_train, y_test, out_folder):
+    """
+    Saves the train/test split as Feather files (or .csv files if pyarrow is not installed) so later runs can reuse it
+    w/o re-reading the input csv (see load_splits())
+    :param X_train: the independent variable training dataframe
+    :param X_test: the independent variable test dataframe
+    :param y_train: the dependent variable training array
+    :param y_test: the dependent variable test array
+    :param out_folder: the model run folder to save the split files in
+    :return: none
+    """
+    splits = {'X_train': X_train.reset_index(drop=True), 'X_test': X_test.reset_index(drop=True),
+              'y_train': pd.DataFrame({'mean_no2': y_train}), 'y_test': pd.DataFrame({'mean_no2': y_test})}
+
+    if importlib.util.find_spec('pyarrow') is not None:
+        ext = '.feather'
+        for name, df in splits.items():
+            df.to_feather(out_folder + '\\%s%s' % (name, ext))
+    else:
+        ext = '.csv'
+        for name, df in splits.items():
+            df.to_csv(out_folder + '\\%s%s' % (name, ext), index=False)
+
+    return logging.info('Train/test split saved as %s files @ %s' % (ext, out_folder))
+
+
+def load_splits(run_folder):
+    """
+    Loads a train/test split saved by save_splits()
+    :param run_folder: a previous MODEL_RUNS/Run# folder containing the .feather (or .csv) split files
+    :return: a list w/ [X_train, X_test, y_train, y_test]
+    """
+    logging.info('Loading train/test split from %s' % run_folder)
+    if os.path.exists(run_folder + '\\X_train.feather'):
+        ext, reader = '.feather', pd.read_feather
+    else:
+        ext, reader = '.csv', pd.read_csv
+
+    X_train = reader(run_folder + '\\X_train%s' % ext)
+    X_test = reader(run_folder + '\\X_test%s' % ext)
+    y_train = reader(run_folder + '\\y_train%s' % ext)['mean_no2'].values
+    y_test = reader(run_folder + '\\y_test%s' % ext)['mean_no2'].values
+
+    return [X_train, X_test, y_train, y_test]
+
+
 def prep_output(main_folder):
     """
     Folder organizing function. Creates sequential  main_folder/MODEL_RUNS/Run# folders to store results.
@@ -67,25 +106,13 @@ def prep_output(main_folder):
     if not os.path.exists(runs_folder):
         os.makedirs(runs_folder)
 
-    folders = os.listdir(runs_folder)
-    subs = [name for name in folders if os.path.isdir(os.path.join(runs_folder, name))]
-    run_dirs = [i for i in subs if 'Run' in i.split()[-1]]
-    out_dir = ''
-    num = 1
-    stop = False
-    while not stop:
-        dir_name = 'Run%s' % num
-        if dir_name in run_dirs:
-            num += 1
-        else:
-            stop = True
-            out_dir = runs_folder + '\\%s' % dir_name
-            os.makedirs(out_dir)
+    # next run number is one more than the highest existing Run# folder
+    nums = [int(m.group(1)) for name in os.listdir(runs_folder) for m in [RUN_DIR_PATTERN.match(name)]
+            if m and os.path.isdir(os.path.join(runs_folder, name))]
+    out_dir = runs_folder + '\\Run%s' % (max(nums, default=0) + 1)
+    os.makedirs(out_dir)
 
-    if out_dir != '':
-        return out_dir
-    else:
-        return logging.info('ERROR: Output folder not defined.')
+    return out_dir
 
 
 def cross_cross(xtr, out_folder=None):
@@ -114,8 +141,19 @@ def cross_cross(xtr, out_folder=None):
 
     out_file = out_folder + '\\x_variables_cross_corrs.png'
 
-    # Compute a correlation matrix and convert to long-form
-    corr_mat = xtr.corr().stack().reset_index(name="correlation")
+    # Compute a correlation matrix of the numeric columns in float32 (np.corrcoef upcasts to float64 unless told not to)
+    # and convert to long-form
+    xtr = xtr.select_dtypes('number')
+    if xtr.shape[1] < 2:
+        return logging.warning('Less than two numeric independent variables, no cross-correlation plot made.')
+
+    arr = xtr.to_numpy(dtype=np.float32)
+    if np.isnan(arr).any():
+        corr = xtr.corr()  # pandas handles missing values pairwise
+    else:
+        cols = xtr.columns
+        corr = pd.DataFrame(np.corrcoef(arr, rowvar=False, dtype=np.float32), index=cols, columns=cols)
+    corr_mat = corr.stack().reset_index(name="correlation")
 
     # Draw each cell as a scatter point with varying size and color
     g = sns.relplot(
@@ -141,25 +179,72 @@ def cross_cross(xtr, out_folder=None):
     return fig
 
 
-def train_xgb(X_train, y_train, param_grid, k, scoring='r2'):
+def gpu_available():
+    """
+    Checks whether XGBoost can train on a CUDA GPU by fitting a tiny model on the 'cuda' device. XGBoost builds w/o CUDA
+    raise an error, while CUDA builds w/o a visible GPU fall back to the CPU, so the device the model used is checked.
+    :return: True if a GPU can be used for training, otherwise False
     """
-    Used GridCV to find optimal XGBoost parameters to fit the training dataset.
+    import json
+    import xgboost as xgb
+
+    if not xgb.build_info().get('USE_CUDA', False):
+        return False
+
+    try:
+        test_model = xgb.XGBRegressor(tree_method='hist', device='cuda', n_estimators=1, verbosity=0)
+        test_model.fit(np.zeros((2, 1)), np.zeros(2))
+    except xgb.core.XGBoostError:
+        return False
+
+    config = json.loads(test_model.get_booster().save_config())
+    device = config['learner'].get('generic_param', {}).get('device', 'cpu')
+
+    return device.startswith('cuda')
+
+
+def train_xgb(X_train, y_train, param_grid, k, scoring='r2', n_iter=60):
+    """
+    Uses a randomized (or full grid) CV search to find optimal XGBoost parameters to fit the training dataset.
     :param X_train: dataframe or XDarray with independent variable training columns
     :param y_train: dataframe or XDarray with dependent variable training columns
     :param params_list: a list of lists of grid paramters to try. Must be of the form
     [gamma_range, eta_range, lambda_range, min_child_weight_range, max_depth_range]
     :param k: Number of K-folds (integer, default passed in via train_and_test workflow is 5)
     :param scoring: a scikit-learn scorer string (default is r2)
+    :param n_iter: number of parameter combinations randomly sampled from param_grid (integer, default is 60). If None,
+    every combination is tried w/ GridSearchCV
     :return: a list containing [model.cv_results_, model.best_estimator_, model.best_params_, model.best_score_]
     """
-    # set up XGBoost regression model
-    xgb_model = xgb.XGBRegressor(eval_metric=r2_score, objective='reg:squarederror', booster='gbtree')
-    xgb_model.fit(X_train, y_train)
-
-    # iterate over all parameter combinations and use the best performer to fit
-    logging.info('Commencing GridSearch...')
+    import xgboost as xgb
+    from sklearn.model_selection import GridSearchCV
+    from sklearn.model_selection import RandomizedSearchCV
+
+    # set up XGBoost regression model w/ the histogram split finder (on the GPU if one is available)
+    device = 'cuda' if gpu_available() else 'cpu'
+    logging.info('Training XGBoost on %s' % device)
+    xgb_model = xgb.XGBRegressor(tree_method='hist', device=device, objective='reg:squarederror', booster='gbtree',
+                                 n_jobs=1, eval_metric='rmse')
+
+    # convert once to float32 so CV folds do not repeat the conversion (a dataframe keeps the feature names)
+    if isinstance(X_train, pd.DataFrame):
+        X_train = X_train.astype(np.float32)
+    else:
+        X_train = np.asarray(X_train, dtype=np.float32)
+
+    # try a random sample (or all) of the parameter combinations and use the best performer to fit. On the CPU the fits
+    # run in parallel processes (each XGBoost fit is single threaded above so they do not oversubscribe the cores), on
+    # the GPU they run one at a time so only one CUDA context shares the GPU memory
+    search_jobs = -1 if device == 'cpu' else 1
+    search_kwargs = dict(cv=k, scoring=scoring, verbose=1, refit=True, return_train_score=True, n_jobs=search_jobs,
+                         pre_dispatch='2*n_jobs')
+    if n_iter is None:
+        logging.info('Commencing GridSearch...')
+        xgb_iters = GridSearchCV(xgb_model, param_grid, **search_kwargs)
+    else:
+        logging.info('Commencing RandomizedSearch over %s parameter combinations...' % n_iter)
+        xgb_iters = RandomizedSearchCV(xgb_model, param_grid, n_iter=n_iter, random_state=0, **search_kwargs)
     logging.info('Using a %s-fold cross-validation' % k)
-    xgb_iters = GridSearchCV(xgb_model, param_grid, cv=k, scoring=scoring, verbose=1, refit=True, return_train_score=True)
     xgb_iters.fit(X_train, y_train)
 
     cv_results_df = pd.DataFrame.from_dict(xgb_iters.cv_results_)
@@ -178,6 +263,8 @@ def test_metrics(y_test, prediction):
     :param prediction: model prediction of the y variable
     :return:
     """
+    from sklearn.metrics import r2_score
+    from sklearn.metrics import mean_squared_error
     logging.info('--------- MODEL TEST PERFORMANCE METRICS ---------')
     r2 = r2_score(y_test, prediction)
     mse = mean_squared_error(y_test, prediction)
@@ -197,18 +284,25 @@ def model_test(X_test, y_test, best_estimator, best_params, out_folder):
     :param out_folder: folder where the plot is saved as a figure
     :return: shows plot
     """
-    from scipy.stats import gaussian_kde
+    import matplotlib.pyplot as plt
+    from scipy.ndimage import gaussian_filter
     model = best_estimator
-    prediction = model.predict(X_test)
+    prediction = model.predict(X_test).astype(np.float32, copy=False)
+    y_test = np.asarray(y_test, dtype=np.float32)
     plt.cla()
     logging.info('Applying model to test dataset...')
 
     # calculate test metrics
     r2 = test_metrics(y_test, prediction)[0]
 
-    # Calculate the point density
-    xy = np.vstack([prediction, y_test])
-    z = gaussian_kde(xy)(xy)
+    # Calculate the point density from a smoothed 2D histogram (linear in the number of test points)
+    hist, x_edges, y_edges = np.histogram2d(prediction, y_test, bins=80)
+    hist = gaussian_filter(hist, sigma=1)
+    ix = np.clip(np.digitize(prediction, x_edges) - 1, 0, hist.shape[0] - 1)
+    iy = np.clip(np.digitize(y_test, y_edges) - 1, 0, hist.shape[1] - 1)
+    z = hist[ix, iy]
+    pred_max = prediction.max()
+    test_max = y_test.max()
 
     # make and format plot
     fig, ax = plt.subplots()
@@ -216,8 +310,8 @@ def model_test(X_test, y_test, best_estimator, best_params, out_folder):
 
     plt.title('XGBoost - Predicting daily mean NO2 concentrations')
     plt.plot(np.arange(0, 60, 0.1), np.arange(0, 60, 0.1), c='red')
-    plt.xlim(0, np.max(prediction))
-    plt.ylim(0, np.max(y_test))
+    plt.xlim(0, pred_max)
+    plt.ylim(0, test_max)
     plt.xlabel('Predicted NO2 concentration')
     plt.ylabel('Actual daily NO2 concentration')
     plt.annotate(best_params, (0.2, 0.9), xycoords='subfigure fraction', fontsize='x-small')
@@ -232,18 +326,34 @@ def model_test(X_test, y_test, best_estimator, best_params, out_folder):
 
 
 def shap_analytics(model, X_train, out_folder):
+    """
+    Plots SHAP feature importance (dot and bar summary plots) for a tree model
+    :param model: a trained XGBoost model (i.e., the GridSearch best_estimator_)
+    :param X_train: the independent variable training dataframe
+    :param out_folder: folder where the plots are saved as figures
+    :return: none
+    """
+    import matplotlib.pyplot as plt
     import shap
-    shap_values = shap.TreeExplainer(model).shap_values(X_train)
+
+    # SHAP plots saturate visually well before 50k rows, so explain a random subsample of large training sets
+    if len(X_train) > 50000:
+        X_train = X_train.sample(5000, random_state=0)
+    X_train = X_train.astype(np.float32)
+
+    # use the fast tree path dependent algorithm and skip the additivity check (re-runs every prediction)
+    explainer = shap.TreeExplainer(model, feature_perturbation='tree_path_dependent')
+    shap_values = explainer.shap_values(X_train, check_additivity=False)
 
     # plot both dot violin and bar plots to track feature importance
     plt.tight_layout()
-    fig1 = shap.summary_plot(shap_values, X_train)
-    fig1.save(out_folder + '\\SHAP_dot_plot.png')
-    plt.cla()
+    shap.summary_plot(shap_values, X_train, show=False)
+    plt.savefig(out_folder + '\\SHAP_dot_plot.png', dpi=300, bbox_inches='tight')
+    plt.clf()
 
-    fig2 = shap.summary_plot(shap_values, X_train, plot_type="bar")
-    fig2.save(out_folder + '\\SHAP_bar_plot.png')
-    plt.cla()
+    shap.summary_plot(shap_values, X_train, plot_type="bar", show=False)
+    plt.savefig(out_folder + '\\SHAP_bar_plot.png', dpi=300, bbox_inches='tight')
+    plt.clf()
 
     return logging.info('SHAP feature importance plots saved @ %s' % out_folder)
 
@@ -255,6 +365,7 @@ def plot_feature_importance(best_estimator, out_folder):
     :param out_folder: folder where the plot is saved as a figure
     :return: shows plot
     """
+    import matplotlib.pyplot as plt
     model = best_estimator
     plt.cla()
     logging.info('Plotting feature importance...')
@@ -276,12 +387,15 @@ def plot_feature_importance(best_estimator, out_folder):
 
 def plot_hyperparams(scoring_df, param_grid, out_folder):
     """
-    This saves the model.cv_results_ item as a csv and saves plots of the distribution of scores for each parameter.
+    This saves the model.cv_results_ item as a csv and plots the distribution of scores for each parameter (one figure).
     :param cv_results_df: the model.cv_results_ item (out_list[0])
     :param param_grid: the param_grid dictionary with param name keys
     :param out_folder: a folder to save plots and .csv in (a sub-folder \\hyper_tuning is made_
     :return: none
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     # make folder to store hyper-parameter tuning
     hyp_dir = out_folder + '\\hyper_tuning'
     logging.info('Summarizing GridSearch hyper-parameters...')
@@ -295,32 +409,35 @@ def plot_hyperparams(scoring_df, param_grid, out_folder):
     scoring_df.to_csv(score_csv)
     logging.info('The model.cv_results_ converted to a .csv @ %s' % score_csv)
 
-    # make a list of hyper parameters to iterate over
-    hypers = list(param_grid.keys())
-    param_cols = []
-    for param in hypers:
-        if param != 'booster':
-            # get column key for dataframe and add to list
-            col_key = 'param_%s' % param
-            param_cols.append(col_key)
-            ax = sns.boxenplot(x=col_key, y='mean_test_score', data=scoring_df)
-            ax.figure.savefig(hyp_dir + '\\%s.png' % param)
-            plt.cla()
-    logging.info('Done. Plots made for each hyper-parameter @ %s' % hyp_dir)
+    # melt the hyper parameter columns to long-form and plot the score distributions as one faceted figure
+    param_cols = ['param_%s' % param for param in param_grid.keys() if param != 'booster']
+    melted = scoring_df.melt(id_vars=['mean_test_score'], value_vars=param_cols, var_name='param', value_name='value')
+    melted['param'] = melted['param'].str.replace('param_', '', regex=False)
+
+    g = sns.catplot(data=melted, x='value', y='mean_test_score', col='param', kind='boxen', col_wrap=3,
+                    sharex=False)
+    g.savefig(hyp_dir + '\\hyper_params.png')
+    plt.close(g.figure)
+    logging.info('Done. Hyper-parameter score distributions plotted @ %s' % hyp_dir)
     return
 
 
-def train_and_run(in_csv, in_cols, params_list, test_prop, k=5):
+def train_and_run(in_csv, in_cols, params_list, test_prop, k=5, n_iter=60, resume_run=None):
     """
-    Master function. Trains and tests an NO2 prediction XGBoost model using GridSearchCV
+    Master function. Trains and tests an NO2 prediction XGBoost model using a randomized or grid CV search
     :param in_csv: path of the csv containing independent and dependent variable columns (string)
     :param in_cols: independent variable column headers (list of strings)
     :param params_list: a list of ranges to test for XGBoost model parameters in the following order:
     [gamma_range, eta_range, lambda_range, colsample_range, max_depth_range]
     :param test_prop: the proportion of the dataset rows to exclude to final testing (float from 0 to 1)
     :param k: the number of K-folds used for cross-validation (integer, default is 5)
+    :param n_iter: the number of parameter combinations randomly sampled for tuning (integer, default is 60), if None
+    the full grid of parameter combinations is searched
+    :param resume_run: a previous MODEL_RUNS/Run# folder (optional), if specified its saved train/test split is reused
+    and the csv is not read
     :return: saves plots and logs @ csv_directory/MODEL_RUNS/Run#
     """
+    import joblib
 
     # set up folders
     main_folder = os.path.dirname(in_csv)
@@ -330,10 +447,6 @@ def train_and_run(in_csv, in_cols, params_list, test_prop, k=5):
     init_logger(__file__, log_name=out_folder + '\\run_log.log')
     logging.info('Inputs variables: %s' % in_cols)
 
-    # pull in data
-    in_data = pd.read_csv(in_csv)
-    in_data = in_data[in_cols]
-
     # set up parameter grid and print out grid nodes
     gammas, etas, lambdas, colsample_range, max_depths = params_list
     param_grid = {'gamma': gammas, 'eta': etas, 'reg_lambda': lambdas, 'colsample_bytree': colsample_range,
@@ -341,15 +454,30 @@ def train_and_run(in_csv, in_cols, params_list, test_prop, k=5):
     for i in param_grid.keys():
         logging.info('Param: %s, testing: %s' % (i, param_grid[i]))
 
-    # prepare model training inputs
-    out = prep_input(in_data, in_cols, test_prop)
-    X_df, Y_df = out[0]  # [0][0] is X dataframe, [0][1] is Y dataframe
-    X_train, X_test, y_train, y_test = out[1]
-    X_train.to_csv(out_folder + '\\X_train.csv')
+    # prepare model training inputs, either from a previous run's saved split or from the csv
+    if resume_run is not None:
+        X_train, X_test, y_train, y_test = load_splits(resume_run)
+        x_cols = [i for i in in_cols if i != 'mean_no2']
+        if set(X_train.columns) != set(x_cols):
+            raise ValueError('Independent variables of the split saved @ %s %s do not match in_cols %s'
+                             % (resume_run, list(X_train.columns), x_cols))
+        logging.info('Reusing the saved train/test split (test_prop is ignored)')
+        X_df = pd.concat([X_train, X_test], ignore_index=True)
+    else:
+        # pull in data, only parsing the used columns from the csv, and downcast the float columns to float32
+        # (text columns are left for prep_input() to clean)
+        in_data = pd.read_csv(in_csv, usecols=in_cols, engine='c')
+        float_cols = in_data.select_dtypes('float64').columns
+        in_data[float_cols] = in_data[float_cols].astype(np.float32)
+        out = prep_input(in_data, in_cols, test_prop)
+        X_df, Y_df = out[0]  # [0][0] is X dataframe, [0][1] is Y dataframe
+        X_train, X_test, y_train, y_test = out[1]
+
+    save_splits(X_train, X_test, y_train, y_test, out_folder)
     cross_cross(X_df, out_folder=out_folder)
 
-    # use GridSearch CV to tune model hyper-parameters
-    out_list = train_xgb(X_train, y_train, param_grid, k=k, scoring='r2')
+    # use a randomized (or grid) CV search to tune model hyper-parameters
+    out_list = train_xgb(X_train, y_train, param_grid, k=k, scoring='r2', n_iter=n_iter)
     best_model = out_list[1]
 
     # plot model performance and feature importance
@@ -362,10 +490,8 @@ def train_and_run(in_csv, in_cols, params_list, test_prop, k=5):
     joblib.dump(best_model, saved_model)
     logging.info('Trained/tuned model saved as %s' % saved_model)
 
-    # do SHAP feature importance analysis
-    X_shap = X_train[in_cols]
-    shap_model = joblib.load(saved_model)
-    shap_analytics(shap_model, X_shap, out_folder)
+    # do SHAP feature importance analysis on the in-memory model (X_train already excludes mean_no2)
+    shap_analytics(best_model, X_train, out_folder)
 
     return
 
@@ -403,9 +529,15 @@ max_depth_range = list(np.arange(4, 9, 1))
 # Do not edit, list is used to store the parameter ranges
 PARAMS_LIST = [gamma_range, eta_range, lambda_range, colsample_range, max_depth_range]
 
+# Number of parameter combinations randomly sampled from the ranges above (None tries every combination)
+N_ITER = 60
+
+# Optional, a previous MODEL_RUNS/Run# folder whose saved train/test split is reused (None reads DATA_CSV)
+RESUME_RUN = None
+
 # runs the train and test pipe line if file is ran
 if __name__ == "__main__":
-    train_and_run(DATA_CSV, INDIE_VARS, PARAMS_LIST, test_prop=TEST_PORTION)
+    train_and_run(DATA_CSV, INDIE_VARS, PARAMS_LIST, test_prop=TEST_PORTION, n_iter=N_ITER, resume_run=RESUME_RUN)
 
 
 
@@ -3,112 +3,316 @@ Quick and useful functions for supporting the NO2 prediction pipeline
 
 author @xaviernogueira
 """
+import atexit
+import importlib.util
 import pandas as pd
+import numpy as np
 import logging
-import matplotlib.pyplot as plt
+import queue
 import os
+import sys
+import time
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from operator import itemgetter
+from pathlib import Path
+
+
+class _MissingModule:
+    """Placeholder for an optional dependency that is not installed, raises ImportError when used"""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        raise ImportError('%s is not installed, it is required to use %s.%s' % (self._name, self._name, attr))
+
+
+def _lazy_import(name):
+    """
+    Imports a module on first attribute access (w/ importlib.util.LazyLoader) to keep this module fast to import
+    :param name: a top level module name (str), find_spec() would eagerly import the parent package of a dotted name
+    :return: the lazily loaded module, or a _MissingModule placeholder if it is not installed
+    """
+    if '.' in name:
+        raise ValueError('Only top level modules can be lazily imported, not %s' % name)
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return _MissingModule(name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# optional dependencies, loaded on first use
+nc = _lazy_import('netCDF4')
+requests = _lazy_import('requests')
+requests_cache = _lazy_import('requests_cache')
+iso3166 = _lazy_import('iso3166')
+gpd = _lazy_import('geopandas')
+shapely = _lazy_import('shapely')
+
+# shared Nominatim session (see _osm_get()) and the time of its last uncached request
+_OSM_SESSION = None
+_OSM_LAST_REQUEST = 0.0
+_OSM_MIN_INTERVAL = 1.0  # Nominatim usage policy allows at most 1 request per second
+_LAT_LON = itemgetter('lat', 'lon')
+
+# bbox_poly() output formats: file extension and OGR driver (None is written as GeoParquet w/ to_parquet())
+_BBOX_FORMATS = {'shp': ('.shp', 'ESRI Shapefile'),
+                 'fgb': ('.fgb', 'FlatGeobuf'),
+                 'parquet': ('.parquet', None)}
+
+# background thread writing the queued log records of init_logger()
+_LOG_LISTENER = None
+
+# variables w/ more chunks than this are slow to read (each chunk is located and decompressed separately)
+_MAX_NCF_CHUNKS = 10000
+
+
+def _stop_logger():
+    """Stops the background logging thread started by init_logger(), flushing any queued log records"""
+    global _LOG_LISTENER
+
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+        for handler in _LOG_LISTENER.handlers:
+            handler.close()
+        _LOG_LISTENER = None
+
+
+atexit.register(_stop_logger)
 
 
 def init_logger(filename, log_name=None):
-    """Initializes logger w/ same name as python file or a specified name if log_name is given a valid path (.log)"""
+    """
+    Initializes logger w/ same name as python file or a specified name if log_name is given a valid path (.log).
+    Log records are queued and written to the log file and stderr by a background thread. Calling again w/ the same log
+    keeps writing to it, a different log replaces the thread and starts a new file.
+    :param filename: the calling python file (i.e., __file__), used to name the log if log_name is not given
+    :param log_name: a .log file path (optional)
+    :return: the logging QueueListener, stopped automatically at exit (or call .stop() to flush the log earlier)
+    """
+    global _LOG_LISTENER
 
     if log_name is not None and log_name[-4:] == '.log':
         if os.path.exists(os.path.dirname(log_name)):
             name = log_name
         else:
-            return print('ERROR: Logger cannot be initiated @ %s' % log_name)
+            raise FileNotFoundError('Logger cannot be initiated @ %s' % log_name)
     else:
         name = os.path.basename(filename).replace('.py', '.log')
 
-    logging.basicConfig(filename=name, filemode='w', level=logging.INFO)
+    # keep logging to the open file if it is the same log (i.e., several functions of a script each call init_logger())
+    if _LOG_LISTENER is not None:
+        open_logs = [h.baseFilename for h in _LOG_LISTENER.handlers if isinstance(h, logging.FileHandler)]
+        if os.path.abspath(name) in open_logs:
+            return _LOG_LISTENER
+
+    # replace the queue handler and listener of any previous call so records are not duplicated
+    _stop_logger()
+    root = logging.getLogger()
+    for handler in [h for h in root.handlers if isinstance(h, QueueHandler)]:
+        root.removeHandler(handler)
+
+    formatter = logging.Formatter(logging.BASIC_FORMAT)
+    file_logger = logging.FileHandler(name, mode='w')
     stderr_logger = logging.StreamHandler()
-    stderr_logger.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
-    logging.getLogger().addHandler(stderr_logger)
+    file_logger.setFormatter(formatter)
+    stderr_logger.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    _LOG_LISTENER = QueueListener(log_queue, file_logger, stderr_logger)
+    _LOG_LISTENER.start()
 
-    return
+    return _LOG_LISTENER
 
 
-def make_test_csv(csv, rows=500):
+def make_test_csv(csv, rows=500, chunksize=100000, usecols=None, dtype=None, head=False, seed=None):
     """
-    Takes a csv and randomly samples N number of rows to make a ML test csv (faster computation)
+    Takes a csv and randomly samples N number of rows to make a ML test csv (faster computation).
+    The csv is streamed in chunks, so only one chunk and the sampled rows are held in memory.
     :param csv: a csv
     :param rows: number of rows for test csv (int, default is 500)
+    :param chunksize: number of csv rows read into memory at a time (int, default is 100000)
+    :param usecols: a list of column headers to keep (optional, default None keeps all columns)
+    :param dtype: a dtype or a dictionary of column headers and dtypes passed to the csv parser (optional)
+    :param head: default is False (bool), if True the first N rows are kept instead of a random sample (fastest)
+    :param seed: a random seed (int, optional) for a reproducible sample
     :return: new test csv
     """
+    if not isinstance(rows, int):
+        return print('ERROR: Rows parameter must be an integer')
 
-    in_df = pd.read_csv(csv)
-    shuffled = in_df.sample(frac=1).reset_index()
-
-    if isinstance(rows, int):
-        out_df = shuffled.sample(n=rows)
+    if head:
+        # only parse the first N rows of the csv
+        out_df = pd.read_csv(csv, nrows=rows, usecols=usecols, dtype=dtype)
 
     else:
-        return print('ERROR: Rows parameter must be an integer')
-
-    out_dir = os.path.dirname(csv)
-    out_csv = out_dir + '\\%s' % os.path.basename(csv).replace('.csv', '_test_%s_rows.csv' % rows)
+        # reservoir sample: give every row a uniform random key and keep the rows w/ the smallest keys over all chunks
+        rng = np.random.default_rng(seed)
+        out_df = None
+        keys = None
+        for chunk in pd.read_csv(csv, chunksize=chunksize, usecols=usecols, dtype=dtype):
+            chunk_keys = pd.Series(rng.random(len(chunk)), index=chunk.index)
+            if out_df is not None:
+                chunk = pd.concat([out_df, chunk])
+                chunk_keys = pd.concat([keys, chunk_keys])
+            keys = chunk_keys.nsmallest(rows)
+            out_df = chunk.loc[keys.index]
+
+    csv_path = Path(csv)
+    out_csv = str(csv_path.with_name('%s_test_%s_rows.csv' % (csv_path.stem, rows)))
 
     out_df.to_csv(out_csv)
     return out_csv
 
 
-def ncf_metadata(ncf_files):
+def _ncf_block(ncf, variables=True):
     """
-    Generates a formatted meta data text file for input .ncf file(s)
-    :param ncf_files: a path (str) or a list of paths (list) to .ncf files
-    :return a text file in the directory of the first .ncf file w/ all input file info
+    Formats the metadata of a single .ncf file for ncf_metadata()
+    :param ncf: a path (str) to a .ncf file
+    :param variables: default is True (bool), if False variable descriptions are skipped
+    :return: the formatted metadata text (str)
     """
-    import netCDF4 as nc
+    parts = ['FILE: %s\n' % ncf]
+    with nc.Dataset(ncf) as ds:
+        for key in ds.ncattrs():
+            parts.append('%s: %s\n' % (key, ds.getncattr(key)))
 
-    print('Input files: %s' % ncf_files)
+        # write the number of dimensions, their names, and sizes
+        dims = ds.dimensions
+        parts.append('\n# of dimensions: %s\n' % len(dims))
+        for dim in dims.values():
+            unlimited = ' (unlimited)' if dim.isunlimited() else ''
+            parts.append("dimension = '%s', size = %s%s\n" % (dim.name, len(dim), unlimited))
 
-    # define output dir for text file
-    if isinstance(ncf_files, list):
-        main_dir = os.path.dirname(ncf_files[0])
-        in_list = ncf_files
-    elif isinstance(ncf_files, str):
-        main_dir = os.path.dirname(ncf_files)
-        in_list = [ncf_files]
-    elif isinstance():
-        return print('ncf_file parameter is not a valid .ncf path of a list of paths')
+        # write all variable descriptions from their attributes (w/o formatting each variable's repr)
+        parts.append('\n# of variables: %s' % len(ds.variables))
+        if variables:
+            for var in ds.variables.values():
+                parts.append('\n%s %s(%s) shape=%s\n' % (var.dtype, var.name, ', '.join(var.dimensions), var.shape))
+                for key in var.ncattrs():
+                    parts.append('    %s: %s\n' % (key, var.getncattr(key)))
+                parts.append(_ncf_chunk_info(ncf, var))
+    parts.append('\n-------------\n')
 
-    # create a new text file
-    txt_dir = main_dir + '\\ncf_files_info.txt'
-    out_txt = open(txt_dir, 'w+')
-    out_txt.write('INPUT FILES METADATA\n----------------\n')
+    return ''.join(parts)
 
-    # format text file with ncf file metadata
-    for ncf in in_list:
-        out_txt.write('FILE: ' + ncf + '\n')
-        ds = nc.Dataset(ncf)
-        ds_dict = ds.__dict__
-        dims = ds.dimensions
-        for key in ds_dict.keys():
-            val = ds_dict[key]
-            out_txt.write('%s: %s\n' % (key, val))
 
-        # write the number of dimensions, their names, and sizes
-        out_txt.write('\n# of dimensions: %s\n' % len(dims))
-        for dim in ds.dimensions.values():
-            dim_txt = str(dim)
-            if 'name' in dim_txt:
-                split = dim_txt.split(':')[1]
-                out = split.replace('name', 'dimension')[1:]
-                out_txt.write(out + '\n')
-
-        # write all variable descriptions
-        variables = ds.variables.values()
-        out_txt.write('\n# of variables: %s' % len(variables))
-        for var in variables:
-            var_txt = str(var)
-            out = var_txt.split('>')[1]
-            out_txt.write('%s\n' % out)
-        out_txt.write('\n-------------\n')
+def _ncf_chunk_info(ncf, var):
+    """
+    Formats the chunk layout and compression of a .ncf variable for _ncf_block(), and logs a warning w/ a suggested
+    nccopy rechunk command if the variable is split into too many chunks (i.e., chunked along time so that reading a
+    single time slice decompresses many slices)
+    :param ncf: the path (str) of the .ncf file holding the variable
+    :param var: a netCDF4 Variable
+    :return: the formatted chunk text (str)
+    """
+    chunks = var.chunking()
+    filters = var.filters() or {}
+
+    if filters.get('zlib'):
+        compression = 'zlib (level %s)' % filters.get('complevel')
+    else:
+        compression = next((key for key in ('zstd', 'bzip2', 'blosc', 'szip') if filters.get(key)), None)
+
+    txt = 'chunk_shape = %s\ncompression = %s\nshuffle = %s\n' % (chunks, compression, bool(filters.get('shuffle')))
+
+    # chunking() returns 'contiguous' (or None for netCDF3 files) when the variable is not chunked
+    if isinstance(chunks, list) and len(chunks) > 0:
+        n_chunks = np.prod(var.shape, dtype=np.float64) / np.prod(chunks, dtype=np.float64)
+        if n_chunks > _MAX_NCF_CHUNKS:
+            # suggest full extent chunks along the other dimensions, and just enough slices of the first (usually
+            # time) dimension per chunk to stay under the chunk limit
+            dims = var.dimensions
+            first_len = max(1, -(-var.shape[0] // _MAX_NCF_CHUNKS))
+            chunk_spec = ','.join(['%s/%s' % (dims[0], first_len)] +
+                                  ['%s/%s' % (d, n) for d, n in zip(dims[1:], var.shape[1:])])
+            logging.warning('%s variable %s is split into %.0f chunks of shape %s, reads may be 10-100x slower. '
+                            'Consider rewriting w/: nccopy -c %s %s rechunked.nc'
+                            % (ncf, var.name, n_chunks, chunks, chunk_spec, ncf))
+
+    return txt
+
+
+def ncf_metadata(ncf_files, variables=True):
+    """
+    Generates a formatted meta data text file for input .ncf file(s), including the chunk shape and compression of each
+    variable (a warning is logged for variables split into > 10000 chunks, as they are slow to read downstream)
+    :param ncf_files: a path (str or Path) or a list of paths (list) to .ncf files
+    :param variables: default is True (bool), if False variable descriptions are skipped (only file attributes and
+    dimensions are written, faster for remote files)
+    :return a text file in the directory of the first .ncf file w/ all input file info
+    """
+    # normalize input to a list of path strings and define output dir for text file
+    if isinstance(ncf_files, (str, os.PathLike)):
+        in_list = [os.fspath(ncf_files)]
+    elif isinstance(ncf_files, (list, tuple)) and len(ncf_files) > 0:
+        in_list = [os.fspath(ncf) for ncf in ncf_files]
+    else:
+        raise TypeError('ncf_files parameter must be a .ncf path or a non-empty list of paths, not %r' % (ncf_files,))
+    main_dir = os.path.dirname(in_list[0])
+    print('Input files: %s' % in_list)
+
+    # create a new text file w/ a large write buffer
+    txt_dir = Path(main_dir) / 'ncf_files_info.txt'
+    out_txt = open(txt_dir, 'w', buffering=1 << 20)
+    out_txt.write('INPUT FILES METADATA\n----------------\n')
+
+    # format the metadata of each unique file one at a time (the netCDF-C/HDF5 libraries are not thread safe, and
+    # reading a header is faster than starting a worker process) and write all files at once
+    blocks = [_ncf_block(ncf, variables) for ncf in dict.fromkeys(in_list)]
+    out_txt.write(''.join(blocks))
     out_txt.close()
 
     return print('METADATA text file @ %s' % txt_dir)
 
 
+def _osm_get(url):
+    """
+    GETs a Nominatim (openstreetmap) url w/ a shared session, responses are cached for 30 days in osm_cache.sqlite
+    (next to the log files) if requests_cache is installed, and uncached requests are spaced >= 1 second apart
+    :param url: a Nominatim url (str)
+    :return: the requests response
+    """
+    global _OSM_SESSION, _OSM_LAST_REQUEST
+
+    if _OSM_SESSION is None:
+        try:
+            _OSM_SESSION = requests_cache.CachedSession('osm_cache', expire_after=30 * 86400)
+        except ImportError:
+            _OSM_SESSION = requests.Session()
+        _OSM_SESSION.headers['User-Agent'] = 'NO2_XGBoost_Prediction_Pipeline'
+
+    # only throttle requests that will actually hit the Nominatim servers
+    cache = getattr(_OSM_SESSION, 'cache', None)
+    if cache is None or not cache.contains(url=url):
+        wait = _OSM_MIN_INTERVAL - (time.monotonic() - _OSM_LAST_REQUEST)
+        if wait > 0:
+            time.sleep(wait)
+
+    response = _OSM_SESSION.get(url)
+    if not getattr(response, 'from_cache', False):
+        _OSM_LAST_REQUEST = time.monotonic()
+
+    return response
+
+
+@lru_cache(maxsize=None)
+def _country_set():
+    """Returns a frozenset of lowercase iso3166 country names, built once on first use"""
+    return frozenset(name.lower() for name in iso3166.countries_by_name)
+
+
 def get_boundingbox(place, output_as='boundingbox', state_override=False):
     """
     Get the bounding box of a country or US state in EPSG4326 given it's name
@@ -122,32 +326,26 @@ def get_boundingbox(place, output_as='boundingbox', state_override=False):
     :param state_override: default is False (bool), only make True if mapping a state
     :return a list with coordinates as floats i.e., [[11.777, 53.7253321, -70.2695876, 7.2274985]]
     """
-    import requests
-    import iso3166
     # create url to pull openstreetmap data
     url_prefix = 'http://nominatim.openstreetmap.org/search?country='
 
-    country_list = [j.lower() for j in iso3166.countries_by_name.keys()]
-
-    if place not in country_list:
+    if place not in _country_set():
         if state_override:
             url_prefix = url_prefix.replace('country=', 'state=')
         else:
             url_prefix = url_prefix.replace('country=', 'city=')
 
     url = '{0}{1}{2}'.format(url_prefix, place, '&format=json&polygon=0')
-    response = requests.get(url).json()[0]
+    response = _osm_get(url).json()[0]
 
-    # parse response to list, convert to integer if desired
+    # parse response to a list of floats ordered longitude first
     if output_as == 'boundingbox':
-        lst = response[output_as]
-        coors = [float(i) for i in lst]
-        output = [coors[-2], coors[-1], coors[0], coors[1]]
+        latmin, latmax, lonmin, lonmax = map(float, response['boundingbox'])
+        output = [lonmin, lonmax, latmin, latmax]
 
     elif output_as == 'center':
-        lst = [response.get(key) for key in ['lat', 'lon']]
-        coors = [float(i) for i in lst]
-        output = [coors[-1], coors[0]]
+        lat, lon = map(float, _LAT_LON(response))
+        output = [lon, lat]
 
     else:
         print('ERROR: output_as parameter must set to either boundingbox or center (str)')
@@ -156,34 +354,39 @@ def get_boundingbox(place, output_as='boundingbox', state_override=False):
     return output
 
 
-def bbox_poly(bbox, region, out_folder):
+def bbox_poly(bbox, region, out_folder, fmt='shp'):
     """
-    Creates a shapefile from a list with bounding box coordinates.
+    Creates a shapefile (or a single file FlatGeobuf/GeoParquet) from a list with bounding box coordinates.
     :param bbox: a list with [latmin, latmax, lonmin, lonmax] (returned from get_boundingbox())
     :param region: a string with a region name (i.e., 'Chicago')
     :param out_folder: a folder path in which to save the created shapefile
-    :return: the shapefile path
+    :param fmt: output format (str), either 'shp' (default, for arcpy), 'fgb' (FlatGeobuf), or 'parquet' (GeoParquet)
+    :return: the output file path
     """
-    import geopandas as gpd
-    from shapely.geometry import Polygon
+    if fmt not in _BBOX_FORMATS:
+        return print('ERROR: fmt parameter must be set to either shp, fgb, or parquet (str)')
+    ext, driver = _BBOX_FORMATS[fmt]
 
     # define output location
-    if not os.path.exists(out_folder):
-        os.makedirs(out_folder)
-
-    out_shp = out_folder + '\\%s_bbox.shp' % region
+    Path(out_folder).mkdir(parents=True, exist_ok=True)
+    out_shp = str(Path(out_folder) / ('%s_bbox%s' % (region, ext)))
 
     # get bounding box coordinates and format
     long0, long1, lat0, lat1 = bbox
     logging.info('Prediction extent coordinates: %s' % bbox)
 
-    poly = Polygon([[long0, lat0],
-                    [long1, lat0],
-                    [long1, lat1],
-                    [long0, lat1]])
-
-    # save as a shapefile and return it's path
-    gpd.GeoDataFrame(pd.DataFrame(['p1'], columns=['geom']),
-                     crs={'init': 'epsg:4326'},
-                     geometry=[poly]).to_file(out_shp)
+    coords = np.array([[long0, lat0],
+                       [long1, lat0],
+                       [long1, lat1],
+                       [long0, lat1],
+                       [long0, lat0]], dtype=np.float64)
+    poly = shapely.Polygon(coords)
+
+    # save (w/ the faster pyogrio engine if installed) and return it's path
+    bbox_gs = gpd.GeoSeries([poly], crs='EPSG:4326')
+    if driver is None:
+        bbox_gs.to_frame('geometry').to_parquet(out_shp)
+    else:
+        write_kwargs = {'engine': 'pyogrio'} if importlib.util.find_spec('pyogrio') is not None else {}
+        bbox_gs.to_file(out_shp, driver=driver, **write_kwargs)
     return out_shp
\ No newline at end of file